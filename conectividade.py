@@ -15,15 +15,21 @@
 # - Perc_Escolas_Ativas >= 0.7 (INCLUI 100%)
 # ============================================================
 
+import os
+import tempfile
 import time
 from pathlib import Path
 from io import BytesIO
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import plotly.graph_objects as go
-import plotly.express as px
 
 # ============================================================
 # CONFIGURAÇÕES
@@ -39,14 +45,29 @@ URL_API = "https://api.simet.nic.br/school-measures/v1/getStatusandSchoolInfoUNI
 
 ARQ_ADESOES = BASES / "adesoes_2025_2028.xlsx"
 ABA_LISTA = "Lista única"
+CACHE_LISTA = BASES / "adesoes_2025_2028.parquet"
 
 CACHE_API = BASES / "api_cache.parquet"
+CACHE_TTL = 3600  # segundos até os dados da API serem baixados de novo
 
 TIMEOUT = 120
 RETRIES = 3
 
 COL_MUN = "co_municipio"
 
+COLS_API = ["co_municipio", "co_entidade", "tp_dependencia", "in_internet", "status"]
+TIPOS_API = {"tp_dependencia": "category", "in_internet": "category", "status": "category"}
+COLS_LISTA = [COL_MUN, "Município", "UF"]
+COLS_TABELA = [
+    "co_municipio",
+    "Município",
+    "UF",
+    "Qtd_Escolas",
+    "Qtd_Escolas_Ativas",
+    "Perc_Escolas_Ativas",
+    "Faixa_Cobertura"
+]
+
 # ============================================================
 # FUNÇÕES AUXILIARES
 # ============================================================
@@ -54,126 +75,228 @@ COL_MUN = "co_municipio"
 def fmt(n):
     return f"{int(n):,}".replace(",", ".")
 
+def gravar_parquet(df, caminho):
+    # Grava em arquivo temporário e troca de uma vez: sessões concorrentes
+    # nunca leem um parquet escrito pela metade
+    fd, tmp = tempfile.mkstemp(dir=caminho.parent, prefix=caminho.name, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, engine="pyarrow", compression="snappy", index=False)
+        os.replace(tmp, caminho)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+@st.cache_data(show_spinner=False)
 def baixar_excel(df, nome_arquivo, nome_aba):
     buffer = BytesIO()
     with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
         df.to_excel(writer, index=False, sheet_name=nome_aba)
-    buffer.seek(0)
-    return buffer
-
-if "cache_limpo" not in st.session_state:
-    try:
-        st.cache_data.clear()
-    except Exception:
-        pass
-    st.session_state["cache_limpo"] = True
+    return buffer.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def criar_gauge(valor, maximo, titulo):
+    # Figura compartilhada (sem cópia por rerun); nunca é alterada depois
+    fig = go.Figure(go.Indicator(
+        mode="gauge+number",
+        value=valor,
+        gauge={"axis": {"range": [0, maximo]}},
+        title={"text": titulo}
+    ))
+    fig.update_layout(height=260)
+    return fig
+
+def contar_por_uf(df):
+    # df já tem uma linha por município: contagem simples por UF
+    uf = df["UF"].value_counts()
+    uf = uf[uf > 0]
+    return tuple(uf.index), tuple(uf.tolist())
+
+@st.cache_resource(show_spinner=False)
+def criar_barras_uf(ufs, qtds):
+    # Chaveado por tuplas (hash barato); a figura é compartilhada sem cópia
+    fig = go.Figure(go.Bar(
+        x=list(ufs),
+        y=list(qtds),
+        text=list(qtds),
+        textposition="outside"
+    ))
+    fig.update_layout(
+        title="Municípios 100% – Metodologia Power BI",
+        xaxis_title="UF",
+        yaxis_title="qtd",
+        height=420
+    )
+    return fig
+
+@st.fragment
+def exibir_tabela(df, titulo, rotulo, nome_arquivo, nome_aba, aberta=False):
+    # Fragmento: o clique no download reexecuta só esta tabela, não a página
+    with st.expander(titulo, expanded=aberta):
+        st.dataframe(pa.Table.from_pandas(df, preserve_index=False), use_container_width=True)
+        st.download_button(
+            rotulo,
+            baixar_excel(df, nome_arquivo, nome_aba),
+            file_name=nome_arquivo,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
 
 # ============================================================
 # LISTA ÚNICA
 # ============================================================
 
 @st.cache_data
-def carregar_lista():
+def carregar_lista(versao):
+    # `versao` (mtime do Excel) renova a cópia em memória; a cópia em parquet
+    # sobrevive a reinícios do servidor, por isso também é conferida
+    if (
+        CACHE_LISTA.exists()
+        and CACHE_LISTA.stat().st_mtime >= ARQ_ADESOES.stat().st_mtime
+    ):
+        return pd.read_parquet(CACHE_LISTA, engine="pyarrow", columns=COLS_LISTA)
+
     df = pd.read_excel(
         ARQ_ADESOES,
         sheet_name=ABA_LISTA,
+        usecols=COLS_LISTA,
         dtype={COL_MUN: str}
     )
-    df[COL_MUN] = df[COL_MUN].astype(str).str.strip()
-    return df.drop_duplicates(subset=[COL_MUN])
+    df[COL_MUN] = pd.to_numeric(df[COL_MUN].str.strip(), errors="coerce").astype("Int64")
+    df["UF"] = df["UF"].astype("category")
+    df = df.drop_duplicates(subset=[COL_MUN])
+    gravar_parquet(df, CACHE_LISTA)
+    return df
 
 # ============================================================
 # API SIMET
 # ============================================================
 
-def carregar_api(forcar=False):
-    if CACHE_API.exists() and not forcar:
-        return pd.read_parquet(CACHE_API)
-
-    for _ in range(RETRIES):
-        try:
-            r = requests.get(URL_API, timeout=TIMEOUT)
-            r.raise_for_status()
-            df = pd.DataFrame(r.json())
-            df.to_parquet(CACHE_API, index=False)
-            return df
-        except Exception:
-            time.sleep(3)
-
-    raise RuntimeError("Erro ao acessar a API SIMET")
+def tipar_api(df):
+    for col in ("co_municipio", "co_entidade"):
+        df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    return df.astype(TIPOS_API)
+
+@st.cache_resource
+def obter_sessao():
+    # Uma sessão por processo: o script reexecuta a cada rerun, e assim a
+    # conexão TCP/TLS é reaproveitada entre tentativas e atualizações
+    sessao = requests.Session()
+    # total conta só as novas tentativas: RETRIES tentativas ao todo
+    sessao.mount("https://", HTTPAdapter(max_retries=Retry(
+        total=RETRIES - 1,
+        backoff_factor=2,
+        status_forcelist=[502, 503, 504]
+    )))
+    return sessao
+
+def baixar_api():
+    try:
+        r = obter_sessao().get(URL_API, timeout=TIMEOUT)
+        r.raise_for_status()
+        dados = orjson.loads(r.content)
+        # from_records preencheria campo ausente com NaN: falha explícita
+        faltando = set(COLS_API) - dados[0].keys()
+        if faltando:
+            raise KeyError(f"Campos ausentes na resposta: {sorted(faltando)}")
+        df = tipar_api(pd.DataFrame.from_records(dados, columns=COLS_API))
+    except Exception as e:
+        raise RuntimeError("Erro ao acessar a API SIMET") from e
+
+    gravar_parquet(df, CACHE_API)
+    return df
+
+def carregar_api():
+    df = pd.read_parquet(CACHE_API, engine="pyarrow", columns=COLS_API)
+    # Cache gravado por versão anterior (sem tipos) é convertido aqui
+    if not isinstance(df["co_municipio"].dtype, pd.Int64Dtype):
+        df = tipar_api(df)
+    return df
 
 # ============================================================
 # PROCESSAMENTO – IGUAL AO POWER BI
 # ============================================================
 
-def processar_powerbi(df_api, df_lista):
+@st.cache_data(show_spinner=False)
+def processar_powerbi(versao_api, versao_lista):
+    # Chaveado pelo mtime das duas bases: reruns da interface reaproveitam
+    # o resultado até um dos arquivos mudar
+    df_api = carregar_api()
+    df_lista = carregar_lista(versao_lista)
 
-    df_api["co_municipio"] = df_api["co_municipio"].astype(str).str.strip()
-
-    # Total de escolas únicas (universo)
-    total_escolas_unicas = df_api["co_entidade"].nunique()
-
-    # BASE = Municipal + Internet = Sim
-    base = df_api[
+    # BASE = Municipal + Internet = Sim, apenas municípios da Lista Única
+    base = df_api.loc[
         (df_api["tp_dependencia"] == "Municipal") &
-        (df_api["in_internet"] == "Sim")
-    ].copy()
-
-    # Apenas municípios da Lista Única
-    base = base[base["co_municipio"].isin(df_lista["co_municipio"])]
-
-    # Denominador
-    qtd_escolas = (
-        base
-        .groupby("co_municipio")["co_entidade"]
-        .nunique()
-        .rename("Qtd_Escolas")
+        (df_api["in_internet"] == "Sim") &
+        df_api["co_municipio"].isin(df_lista["co_municipio"])
+    ]
+
+    # Uma linha por escola: ativa se teve ao menos uma medição "ativo"
+    escolas = (
+        base["status"].eq("ativo")
+        .rename("is_ativo")
+        .groupby([base["co_municipio"], base["co_entidade"]], sort=False)
+        .any()
         .reset_index()
     )
 
-    # Numerador
-    qtd_escolas_ativas = (
-        base[base["status"] == "ativo"]
-        .groupby("co_municipio")["co_entidade"]
-        .nunique()
-        .rename("Qtd_Escolas_Ativas")
+    # Denominador e numerador em uma única agregação
+    df_mun = (
+        escolas
+        .groupby("co_municipio", sort=False)
+        .agg(
+            Qtd_Escolas=("co_entidade", "size"),
+            Qtd_Escolas_Ativas=("is_ativo", "sum")
+        )
+        .astype("int32")
+        .sort_index()  # ordena só o resultado agregado
         .reset_index()
     )
 
-    df_mun = qtd_escolas.merge(
-        qtd_escolas_ativas,
-        on="co_municipio",
-        how="left"
-    ).fillna(0)
-
-    df_mun["Qtd_Escolas_Ativas"] = df_mun["Qtd_Escolas_Ativas"].astype(int)
     df_mun["Perc_Escolas_Ativas"] = (
         df_mun["Qtd_Escolas_Ativas"] / df_mun["Qtd_Escolas"]
     )
 
-    def faixa(p):
-        if p == 1:
-            return "100%"
-        elif p >= 0.8:
-            return "80% - 99%"
-        elif p >= 0.7:
-            return "70% - 79%"
-        elif p >= 0.5:
-            return "50% - 69%"
-        elif p > 0:
-            return "<50%"
-        else:
-            return "0%"
-
-    df_mun["Faixa_Cobertura"] = df_mun["Perc_Escolas_Ativas"].apply(faixa)
-
-    df_mun = df_mun.merge(
-        df_lista[["co_municipio", "UF", "Município"]],
-        on="co_municipio",
-        how="left"
+    p = df_mun["Perc_Escolas_Ativas"].to_numpy()
+    faixas = ["100%", "80% - 99%", "70% - 79%", "50% - 69%", "<50%", "0%"]
+    df_mun["Faixa_Cobertura"] = pd.Categorical(
+        np.select(
+            [p == 1, p >= 0.8, p >= 0.7, p >= 0.5, p > 0],
+            faixas[:-1],
+            default="0%"
+        ),
+        categories=faixas
     )
 
-    return df_mun, base, total_escolas_unicas
+    # UF e Município via lookup (Lista Única já é única por município)
+    lista = df_lista.set_index("co_municipio")
+    df_mun["UF"] = df_mun["co_municipio"].map(lista["UF"])
+    df_mun["Município"] = df_mun["co_municipio"].map(lista["Município"])
+
+    # Ordenado por percentual (decrescente), cada faixa é um prefixo da tabela
+    df_ordenado = df_mun[COLS_TABELA].sort_values(
+        "Perc_Escolas_Ativas", ascending=False, kind="stable"
+    )
+    pct_ordenado = -df_ordenado["Perc_Escolas_Ativas"].to_numpy()
+    n_100 = np.searchsorted(pct_ordenado, -1.0, side="right")
+    n_70 = np.searchsorted(pct_ordenado, -0.7, side="right")
+
+    # Fatias por posição são views do frame já projetado
+    tabela_100 = df_ordenado.iloc[:n_100]
+    tabela_70 = df_ordenado.iloc[:n_70]
+
+    # Números dos cards e velocímetros, calculados junto com o cache
+    escolas_com_internet = len(escolas)
+    escolas_ativas = int(escolas["is_ativo"].sum())
+    resumo = {
+        "escolas_unicas": int(df_api["co_entidade"].nunique()),  # universo
+        "escolas_com_internet": escolas_com_internet,
+        "escolas_ativas": escolas_ativas,
+        "escolas_sem_medidor": escolas_com_internet - escolas_ativas,
+        "municipios_total": len(df_mun),
+        "municipios_100": int(n_100),
+    }
+
+    return resumo, tabela_100, tabela_70
 
 # ============================================================
 # EXECUÇÃO
@@ -181,30 +304,31 @@ def processar_powerbi(df_api, df_lista):
 
 atualizar = st.button("🔄 Atualizar dados")
 
-df_lista = carregar_lista()
-df_api = carregar_api(atualizar)
+if atualizar or not CACHE_API.exists():
+    baixar_api()
+elif time.time() - CACHE_API.stat().st_mtime > CACHE_TTL:
+    # Atualização automática: se a API falhar, segue com o último cache
+    try:
+        baixar_api()
+    except RuntimeError:
+        st.warning("Não foi possível atualizar a API SIMET; exibindo o último cache.")
 
 with st.spinner("Processando dados (metodologia Power BI)..."):
-    df_mun, base, total_escolas_unicas = processar_powerbi(df_api, df_lista)
+    resumo, tabela_100, tabela_70 = processar_powerbi(
+        CACHE_API.stat().st_mtime,
+        ARQ_ADESOES.stat().st_mtime
+    )
 
 # ============================================================
 # CARDS
 # ============================================================
 
-total_escolas_com_internet = base["co_entidade"].nunique()
-total_escolas_ativas = base[base["status"] == "ativo"]["co_entidade"].nunique()
-total_escolas_sem_medidor = total_escolas_com_internet - total_escolas_ativas
-
-municipios_total = df_mun["co_municipio"].nunique()
-municipios_100 = df_mun[df_mun["Faixa_Cobertura"] == "100%"]
-municipios_70_mais = df_mun[df_mun["Perc_Escolas_Ativas"] >= 0.7]
-
 c1, c2, c3, c4, c5 = st.columns(5)
-c1.metric("🏫 Total de Escolas", fmt(total_escolas_unicas))
-c2.metric("🌐 Escolas com Internet", fmt(total_escolas_com_internet))
-c3.metric("📟 Internet + Medidor", fmt(total_escolas_ativas))
-c4.metric("🚫 Internet sem Medidor", fmt(total_escolas_sem_medidor))
-c5.metric("🏙️ Municípios 100%", fmt(len(municipios_100)))
+c1.metric("🏫 Total de Escolas", fmt(resumo["escolas_unicas"]))
+c2.metric("🌐 Escolas com Internet", fmt(resumo["escolas_com_internet"]))
+c3.metric("📟 Internet + Medidor", fmt(resumo["escolas_ativas"]))
+c4.metric("🚫 Internet sem Medidor", fmt(resumo["escolas_sem_medidor"]))
+c5.metric("🏙️ Municípios 100%", fmt(resumo["municipios_100"]))
 
 st.divider()
 
@@ -212,21 +336,16 @@ st.divider()
 # VELOCÍMETROS
 # ============================================================
 
-fig1 = go.Figure(go.Indicator(
-    mode="gauge+number",
-    value=total_escolas_com_internet,
-    gauge={"axis": {"range": [0, total_escolas_unicas]}},
-    title={"text": "Escolas com Internet / Total de Escolas"}
-))
-fig1.update_layout(height=260)
-
-fig2 = go.Figure(go.Indicator(
-    mode="gauge+number",
-    value=len(municipios_100),
-    gauge={"axis": {"range": [0, municipios_total]}},
-    title={"text": "Municípios 100% (Power BI)"}
-))
-fig2.update_layout(height=260)
+fig1 = criar_gauge(
+    resumo["escolas_com_internet"],
+    resumo["escolas_unicas"],
+    "Escolas com Internet / Total de Escolas"
+)
+fig2 = criar_gauge(
+    resumo["municipios_100"],
+    resumo["municipios_total"],
+    "Municípios 100% (Power BI)"
+)
 
 g1, g2 = st.columns(2)
 g1.plotly_chart(fig1, use_container_width=True)
@@ -238,22 +357,7 @@ st.divider()
 # GRÁFICO POR UF
 # ============================================================
 
-uf_100 = (
-    municipios_100
-    .groupby("UF", as_index=False)
-    .agg(qtd=("co_municipio", "nunique"))
-    .sort_values("qtd", ascending=False)
-)
-
-fig = px.bar(
-    uf_100,
-    x="UF",
-    y="qtd",
-    text="qtd",
-    title="Municípios 100% – Metodologia Power BI"
-)
-fig.update_traces(textposition="outside")
-fig.update_layout(height=420)
+fig = criar_barras_uf(*contar_por_uf(tabela_100))
 
 st.plotly_chart(fig, use_container_width=True)
 
@@ -263,35 +367,19 @@ st.divider()
 # TABELAS + DOWNLOAD (COLUNAS AJUSTADAS)
 # ============================================================
 
-colunas_tabela = [
-    "co_municipio",
-    "Município",
-    "UF",
-    "Qtd_Escolas",
-    "Qtd_Escolas_Ativas",
-    "Perc_Escolas_Ativas",
-    "Faixa_Cobertura"
-]
-
-tabela_100 = municipios_100[colunas_tabela]
-tabela_70 = municipios_70_mais[colunas_tabela]
-
-st.subheader("🏙️ Municípios 100% (Power BI)")
-st.dataframe(tabela_100, use_container_width=True)
-
-st.download_button(
+exibir_tabela(
+    tabela_100,
+    "🏙️ Municípios 100% (Power BI)",
     "📥 Baixar municípios 100% (Excel)",
-    baixar_excel(tabela_100, "municipios_100_powerbi.xlsx", "Municipios_100"),
-    file_name="municipios_100_powerbi.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    "municipios_100_powerbi.xlsx",
+    "Municipios_100",
+    aberta=True
 )
 
-st.subheader("🏙️ Municípios ≥ 70% (Power BI)")
-st.dataframe(tabela_70, use_container_width=True)
-
-st.download_button(
+exibir_tabela(
+    tabela_70,
+    "🏙️ Municípios ≥ 70% (Power BI)",
     "📥 Baixar municípios ≥ 70% (Excel)",
-    baixar_excel(tabela_70, "municipios_70_mais_powerbi.xlsx", "Municipios_70_mais"),
-    file_name="municipios_70_mais_powerbi.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-)
\ No newline at end of file
+    "municipios_70_mais_powerbi.xlsx",
+    "Municipios_70_mais"
+)